@@ -1,60 +1,322 @@
 import streamlit as st
 import requests
-import json
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+import atexit
 import logging
+import logging.handlers
+import queue
+import socket
+import threading
+import time
+
+# Prefer a C JSON parser for the per-line streaming hot loop, falling back to the stdlib
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        import json as fast_json
+
+# Optional on-demand parser for the model listing
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
 
 # Configure logging
-logging.basicConfig(filename='app.log', level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+@st.cache_resource
+def configure_logging():
+    # QueueHandler still formats each record on the calling thread, but the
+    # app.log writes happen on a listener thread, keeping disk I/O out of the
+    # streaming loop.
+    root = logging.getLogger()
+    for handler in root.handlers:
+        # Installed by an earlier run whose cached resource was cleared
+        if isinstance(handler, logging.handlers.QueueHandler):
+            return handler.listener
+    file_handler = logging.FileHandler('app.log')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    root.setLevel(logging.INFO)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.listener = listener
+    root.addHandler(queue_handler)
+    return listener
+
+configure_logging()
 
 SYSTEM_PROMPT = "Chat like friends about any topic. Keep it casual, light, sometimes funny. Stay safe and respectful."
 OLLAMA_HOST = 'http://localhost:11434'
+# Built once and prepended to every request; never mutate it
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Streamed tokens are rendered in batches rather than one markdown update per chunk
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.025  # seconds
+# How long the script thread waits for a chunk before redrawing while a reply is pending
+STREAM_POLL_INTERVAL = 0.1  # seconds
+# Long replies only show their tail while streaming; the full text is rendered once at the end
+STREAM_PREVIEW_CHARS = 4000
+# Default number of most recent messages sent to the model each turn
+MAX_CTX_MSGS = 16
+
+@st.cache_resource
+def get_session():
+    # Streamlit re-executes this module on every rerun, so the pooled session
+    # is kept as a cached resource to preserve keep-alive connections.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": "application/json"})
+    return session
+
+def parse_model_names(response):
+    if simdjson is not None:
+        try:
+            # Only the name fields are materialized; the rest of each entry is skipped
+            parser = simdjson.Parser()
+            return [m['name'] for m in parser.parse(response.content)["models"]]
+        except (RuntimeError, ValueError):
+            pass  # Fall through so malformed bodies raise the usual requests error
+    return [m['name'] for m in response.json()["models"]]
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_models():
+    # Cached so that reruns don't probe Ollama on every widget interaction.
+    # Failures raise and are therefore never cached.
+    logging.info("Attempting to connect to Ollama...")
+    response = get_session().get(f"{OLLAMA_HOST}/api/tags")
+    response.raise_for_status()
+    models = parse_model_names(response)
+    logging.info("Successfully connected to Ollama.")
+    return models
 
 def get_models():
     try:
-        logging.info("Attempting to connect to Ollama...")
-        response = requests.get(f"{OLLAMA_HOST}/api/tags")
-        response.raise_for_status()
-        models = [m['name'] for m in response.json()["models"]]
-        logging.info("Successfully connected to Ollama.")
-        return models
+        return fetch_models()
     except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to connect to Ollama: {e}", exc_info=True)
+        logging.error("Failed to connect to Ollama: %s", e, exc_info=True)
         st.error("Ollama is not running or not reachable. Please check the logs in app.log for more details.")
         st.stop()
 
-def generate_response(model, messages):
-    # Create a clean version of the messages for the model
-    model_messages = []
-    for i, msg in enumerate(messages):
-        role = "user" if i == len(messages) - 1 else "assistant"
-        model_messages.append({"role": role, "content": msg["content"]})
+def _iter_stream_lines(response, chunk_size=8192):
+    # Split the raw byte stream on newlines using one buffer and a scan cursor.
+    # Unlike iter_lines, a line spanning many network chunks is not re-joined
+    # with the pending tail and re-split on every chunk.
+    buf = bytearray()
+    scan = 0
+    for data in response.iter_content(chunk_size=chunk_size):
+        buf += data
+        start = 0
+        while True:
+            end = buf.find(b"\n", scan)
+            if end == -1:
+                break
+            # Tolerate CRLF-delimited streams with a single C-level strip
+            yield bytes(memoryview(buf)[start:end]).rstrip(b"\r")
+            start = scan = end + 1
+        if start:
+            del buf[:start]
+        scan = len(buf)
+    if buf:
+        yield bytes(buf).rstrip(b"\r")
+
+class ChatStream:
+    # One reply read on a reader thread and consumed by the script thread,
+    # which may cancel it at any time (Stop, a discarded prefetch, ...)
+    def __init__(self, slots):
+        self.chunks = queue.Queue()
+        self.stop = threading.Event()
+        self.slots = slots
+        self.response = None
+        # Guards response so cancel() never touches a connection that has
+        # already gone back to the session's pool
+        self.response_lock = threading.Lock()
+
+    def acquire_slot(self):
+        # Wait for a free slot, giving up as soon as the stream is cancelled
+        while not self.stop.is_set():
+            if self.slots.acquire(timeout=0.1):
+                if self.stop.is_set():
+                    self.slots.release()
+                    return False
+                return True
+        return False
+
+    def cancel(self):
+        self.stop.set()
+        with self.response_lock:
+            if self.response is None:
+                return
+            # response.close() would wait on the lock held by the reader while it
+            # is blocked in recv(); shutting the socket down makes recv() return
+            # at once, so the reader fails its read and exits.
+            sock = getattr(self.response.raw.connection, "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # Already closed
+
+def _stream_chat(session, body, stream):
+    # Runs on a reader thread so network reads are not serialized behind
+    # rendering in the script thread. Must not call any st.* API.
+    try:
+        if not stream.acquire_slot():
+            return
+        try:
+            # A request still waiting for its response headers (prefill, model
+            # load) can't be interrupted; it notices the stop once they arrive
+            with session.post(f"{OLLAMA_HOST}/api/chat", data=body, headers={"Content-Type": "application/json"}, stream=True) as response:
+                with stream.response_lock:
+                    stream.response = response
+                try:
+                    if stream.stop.is_set():
+                        return
+                    response.raise_for_status()
+                    for line in _iter_stream_lines(response):
+                        if stream.stop.is_set():
+                            break
+                        if line:
+                            try:
+                                # Lines are parsed straight from bytes; no intermediate str decode
+                                json_line = fast_json.loads(line)
+                                if "message" in json_line and "content" in json_line["message"]:
+                                    stream.chunks.put(json_line["message"]["content"])
+                            except ValueError:
+                                # Only this rare path decodes the line to text
+                                logging.warning("Received non-JSON line from stream: %s", line.decode("utf-8", errors="replace"))
+                finally:
+                    with stream.response_lock:
+                        stream.response = None
+        finally:
+            # Held until the request is really over, so the slots bound what Ollama is working on
+            stream.slots.release()
+    except requests.exceptions.RequestException as e:
+        # A read interrupted by cancel() is expected, not an error
+        if not stream.stop.is_set():
+            stream.chunks.put(e)
+    finally:
+        # None marks the end of the stream; a module-level sentinel object
+        # would not survive Streamlit re-executing this script.
+        stream.chunks.put(None)
+
+def trim_history(model_messages, context_limit):
+    # Prefill time grows with the prompt, so only the most recent messages are
+    # resent. The opening topic message is always kept.
+    if not context_limit or len(model_messages) <= context_limit:
+        return model_messages
+    if context_limit == 1:
+        # No room for the topic; the newest message is the one to answer
+        return model_messages[-1:]
+    return [model_messages[0], *model_messages[len(model_messages) - context_limit + 1:]]
 
-    logging.info(f"Prompt sent to {model}: {model_messages}")
+def start_response(model, model_messages, context_limit=0):
+    model_messages = trim_history(model_messages, context_limit)
+    logging.info("Prompt sent to %s: %d messages", model, len(model_messages))
+    # The full prompt dump is only formatted when debug logging is enabled
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Prompt sent to %s: %s", model, model_messages)
     
     payload = {
         "model": model,
-        "messages": model_messages,
+        "messages": [_SYSTEM_MSG, *model_messages],
         "stream": True,
-        "system": SYSTEM_PROMPT,
     }
+    # Encoded on the script thread, with the fast encoder when available, so the
+    # reader never serializes a history that the script may go on to mutate
+    body = fast_json.dumps(payload)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if "stream_slots" not in st.session_state:
+        # The current turn plus one dispatched ahead of time. A cancelled request
+        # keeps its slot until its reader exits, which can take until its
+        # response headers arrive if it was cancelled during prefill.
+        st.session_state.stream_slots = threading.BoundedSemaphore(2)
+    stream = ChatStream(st.session_state.stream_slots)
+    threading.Thread(target=_stream_chat, args=(get_session(), body, stream), daemon=True).start()
+    return stream
+
+def generate_response(model, stream):
+    try:
+        while True:
+            try:
+                chunk = stream.chunks.get(timeout=STREAM_POLL_INTERVAL)
+            except queue.Empty:
+                # Nothing yet, e.g. during prefill. An empty chunk lets the caller
+                # redraw the cursor, which is also where a Stop click takes effect.
+                yield ""
+                continue
+            if chunk is None:
+                break
+            if isinstance(chunk, requests.exceptions.RequestException):
+                logging.error("Error during API call to %s: %s", model, chunk, exc_info=chunk)
+                st.error(f"An error occurred while communicating with the model: {chunk}")
+                st.session_state.running = False
+                st.rerun()
+            yield chunk
+    finally:
+        # Drop the connection if the consumer stops early
+        stream.cancel()
+
+def prefetch_response(model, model_messages, context_limit):
+    # Dispatch the next turn's request right away so the model's prefill
+    # overlaps with finalizing the current turn and any rerun that follows.
+    discard_prefetched_response()
+    key = (model, len(model_messages), context_limit)
+    st.session_state.next_stream = (key, start_response(model, model_messages, context_limit))
+
+def take_prefetched_response(model, model_messages, context_limit):
+    pending = st.session_state.pop("next_stream", None)
+    if pending is None:
+        return None
+    key, stream = pending
+    if key == (model, len(model_messages), context_limit):
+        return stream
+    # The agent's model, the history or the context window changed since it was dispatched
+    stream.cancel()
+    return None
+
+def discard_prefetched_response():
+    pending = st.session_state.pop("next_stream", None)
+    if pending is not None:
+        pending[1].cancel()
+
+def _load_model(session, model):
     try:
-        with requests.post(f"{OLLAMA_HOST}/api/chat", json=payload, stream=True) as response:
+        # An empty chat makes Ollama load the model without generating anything
+        with session.post(f"{OLLAMA_HOST}/api/chat", json={"model": model, "messages": []}) as response:
             response.raise_for_status()
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        json_line = json.loads(line)
-                        if "message" in json_line and "content" in json_line["message"]:
-                            yield json_line["message"]["content"]
-                    except json.JSONDecodeError:
-                        logging.warning(f"Received non-JSON line from stream: {line}")
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error during API call to {model}: {e}", exc_info=True)
-        st.error(f"An error occurred while communicating with the model: {e}")
-        st.session_state.running = False
-        st.rerun()
+        logging.warning("Failed to preload model %s: %s", model, e)
+
+def warm_up_model(model):
+    # Hide the cold model-load cost of the agent that speaks second
+    threading.Thread(target=_load_model, args=(get_session(), model), daemon=True).start()
+
+def add_message(role, content):
+    message = {"role": role, "content": content, "timestamp": datetime.now().strftime("%H:%M:%S")}
+    st.session_state.messages.append(message)
+    # Mirror the history in the model's format: only the latest message is sent as
+    # "user", so the previous one is flipped to "assistant" instead of rebuilding the list
+    if st.session_state.model_messages:
+        st.session_state.model_messages[-1]["role"] = "assistant"
+    st.session_state.model_messages.append({"role": "user", "content": content})
+    # Grow the export body alongside the history instead of re-joining it on every rerun
+    entry = f"**{message['role']}** ({message['timestamp']})\n{message['content']}"
+    st.session_state.export_body += f"\n{entry}" if st.session_state.export_body else entry
+
+def current_agent(messages):
+    # Agents alternate; Agent 1 opens with the topic
+    if len(messages) % 2 != 0:
+        return "Agent 2", st.session_state.agent2_model
+    return "Agent 1", st.session_state.agent1_model
 
 def main():
     st.title("Auto-pilot Chatting Agents")
@@ -91,9 +353,12 @@ def main():
 
     topic = st.text_input("Enter a topic for the agents to discuss", "")
     turn_limit = st.number_input("Turn limit (minutes, 0 for unlimited)", min_value=0, value=10)
+    context_limit = st.number_input("Context window (messages sent to the model, 0 for full history)", min_value=0, value=MAX_CTX_MSGS)
 
     if "messages" not in st.session_state:
         st.session_state.messages = []
+        st.session_state.model_messages = []
+        st.session_state.export_body = ""
 
     if "running" not in st.session_state:
         st.session_state.running = False
@@ -109,42 +374,63 @@ def main():
             st.session_state.running = True
             st.session_state.start_time = datetime.now()
             st.session_state.finish_time = None
-            st.session_state.messages = [{"role": "Agent 1", "content": topic, "timestamp": datetime.now().strftime("%H:%M:%S")}]
+            discard_prefetched_response()
+            st.session_state.messages = []
+            st.session_state.model_messages = []
+            st.session_state.export_body = ""
+            add_message("Agent 1", topic)
+            # Start the first reply before rerunning and load the other agent's model meanwhile
+            prefetch_response(current_agent(st.session_state.messages)[1], st.session_state.model_messages, context_limit)
+            if st.session_state.agent1_model != st.session_state.agent2_model:
+                warm_up_model(st.session_state.agent1_model)
             st.rerun()
 
     with col2:
         if st.button("Stop", disabled=not st.session_state.running):
             st.session_state.running = False
             st.session_state.finish_time = datetime.now()
+            discard_prefetched_response()
             st.rerun()
 
-    if st.session_state.running:
+    # Turns follow each other within a single script run; st.rerun() is only
+    # used when the conversation changes state (stop, time limit, failure).
+    while st.session_state.running:
         if turn_limit > 0 and (datetime.now() - st.session_state.start_time).total_seconds() > turn_limit * 60:
             st.session_state.running = False
             st.session_state.finish_time = datetime.now()
+            discard_prefetched_response()
             st.warning("Time limit reached. Conversation stopped.")
             st.rerun()
 
         # Determine the current agent and model from session state
-        if len(st.session_state.messages) % 2 != 0:
-            current_agent_model = st.session_state.agent2_model
-            current_agent_name = "Agent 2"
-        else:
-            current_agent_model = st.session_state.agent1_model
-            current_agent_name = "Agent 1"
+        current_agent_name, current_agent_model = current_agent(st.session_state.messages)
 
-        logging.info(f"Current agent: {current_agent_name}, Model: {current_agent_model}")
+        logging.info("Current agent: %s, Model: %s", current_agent_name, current_agent_model)
 
         with st.chat_message(current_agent_name):
+            header_placeholder = st.empty()
             message_placeholder = st.empty()
             full_response = ""
             # Check if we should stop before starting the response
             if not st.session_state.running:
                 st.rerun()
 
-            for chunk in generate_response(current_agent_model, st.session_state.messages):
+            pending_chars = 0
+            last_flush = time.monotonic()
+            stream = take_prefetched_response(current_agent_model, st.session_state.model_messages, context_limit)
+            if stream is None:
+                stream = start_response(current_agent_model, st.session_state.model_messages, context_limit)
+            for chunk in generate_response(current_agent_model, stream):
                 full_response += chunk
-                message_placeholder.markdown(full_response + "▌")
+                pending_chars += len(chunk)
+                now = time.monotonic()
+                if pending_chars >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                    if len(full_response) > STREAM_PREVIEW_CHARS:
+                        message_placeholder.markdown("…" + full_response[-STREAM_PREVIEW_CHARS:] + "▌")
+                    else:
+                        message_placeholder.markdown(full_response + "▌")
+                    pending_chars = 0
+                    last_flush = now
                 # Check if the stop button was pressed during generation
                 if not st.session_state.running:
                     break
@@ -156,35 +442,45 @@ def main():
             # Validate the response
             if not full_response or not full_response.strip():
                 st.error(f"{current_agent_name} ({current_agent_model}) failed to generate a response. The conversation has been stopped.")
-                logging.warning(f"Model {current_agent_model} returned an empty response.")
+                logging.warning("Model %s returned an empty response.", current_agent_model)
                 st.session_state.running = False
                 st.rerun()
             else:
-                st.session_state.messages.append({"role": current_agent_name, "content": full_response, "timestamp": datetime.now().strftime("%H:%M:%S")})
-                st.rerun()
+                add_message(current_agent_name, full_response)
+                prefetch_response(current_agent(st.session_state.messages)[1], st.session_state.model_messages, context_limit)
+                # Finish the bubble in place so it matches the history rendering
+                header_placeholder.markdown(f"**{current_agent_name}** ({st.session_state.messages[-1]['timestamp']})")
 
     with col3:
         if "start_time" in st.session_state and st.session_state.start_time:
-            start_time_str = st.session_state.start_time.strftime('%Y-%m-%d %H:%M:%S')
-            finish_time_str = st.session_state.finish_time.strftime('%Y-%m-%d %H:%M:%S') if st.session_state.finish_time else "Not finished"
-            
-            chat_export = f"""
+            # Captured for make_export, which Streamlit calls from another thread
+            # where session state isn't available
+            start_time = st.session_state.start_time
+            finish_time = st.session_state.finish_time
+            agent1_model = st.session_state.agent1_model
+            agent2_model = st.session_state.agent2_model
+            export_body = st.session_state.export_body
+
+            def make_export():
+                # Only built when the user actually clicks "Save chat"
+                start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
+                finish_time_str = finish_time.strftime('%Y-%m-%d %H:%M:%S') if finish_time else "Not finished"
+                return f"""
 # Chat on Topic: {topic}
 
 **Start Time:** {start_time_str}
 **Finish Time:** {finish_time_str}
 
-**Agent 1 Model:** {st.session_state.agent1_model}
-**Agent 2 Model:** {st.session_state.agent2_model}
+**Agent 1 Model:** {agent1_model}
+**Agent 2 Model:** {agent2_model}
 
 ---
 
-"""
-            chat_export += "\n".join([f"**{m['role']}** ({m['timestamp']})\n{m['content']}" for m in st.session_state.messages])
+""" + export_body
 
             if st.download_button(
                 label="Save chat",
-                data=chat_export,
+                data=make_export,
                 file_name=f"chat_{datetime.now().strftime('%Y%m%d')}.md",
                 mime="text/markdown",
                 disabled=not st.session_state.messages